@@ -1,30 +1,63 @@
 import os
-import json
+import orjson
+import atexit
+import anyio
 import asyncio
+import threading
+import time
+import httpx
 import streamlit as st
 from dotenv import load_dotenv
 
 from langchain_openai import ChatOpenAI 
 from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_mcp_adapters.tools import load_mcp_tools
+from mcp.shared.exceptions import McpError
 from langchain_core.messages import HumanMessage, AIMessage, ToolMessage, SystemMessage
 
-load_dotenv()
+from llm_cache import CachedLLM
+
+try:
+    import uvloop  # not available on Windows
+except ImportError:
+    uvloop = None
 
 # ─────────────────────────────
 # CONFIGURATION
 # ─────────────────────────────
-MCP_TOKEN = st.secrets.get("MCP_TOKEN") or os.getenv("MCP_TOKEN")
-OPENAI_API_KEY = st.secrets.get("OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY")
+@st.cache_resource
+def _bootstrap():
+    # Read .env and secrets once per process, not on every rerun
+    load_dotenv()
+    return (
+        st.secrets.get("MCP_TOKEN") or os.getenv("MCP_TOKEN"),
+        st.secrets.get("OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY"),
+    )
+
+MCP_TOKEN, OPENAI_API_KEY = _bootstrap()
 
 if not MCP_TOKEN or not OPENAI_API_KEY:
+    _bootstrap.clear()  # re-read once the secrets are added
     st.error("🚨 Missing Secrets! Please add `OPENAI_API_KEY` and `MCP_TOKEN` to your settings.")
     st.stop()
 
+def http_client_factory(headers=None, timeout=None, auth=None):
+    # HTTP/2 multiplexes parallel tool calls over one connection
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+        headers=headers,
+        timeout=timeout or httpx.Timeout(30),
+        auth=auth,
+        follow_redirects=True,
+    )
+
 SERVERS = {
     "expense": {
         "transport": "streamable_http",
         "url": "https://aniruddh.fastmcp.app/mcp", 
-        "headers": {"Authorization": f"Bearer {MCP_TOKEN}"}
+        "headers": {"Authorization": f"Bearer {MCP_TOKEN}"},
+        "httpx_client_factory": http_client_factory,
     }
 }
 
@@ -32,37 +65,153 @@ SERVERS = {
 SYSTEM_PROMPT = (
     "You are a helpful assistant with tool access. "
     "When providing final answers after using a tool, always summarize the data "
-    "in a clear, human-readable textual format. Never show raw JSON to the user."
+    "in a clear, human-readable textual format. Never show raw JSON to the user. "
+    "When multiple independent pieces of information are needed, emit all tool_calls "
+    "in a single response so they execute in parallel. Only call sequentially when "
+    "one call's arguments depend on another's output."
 )
 
+# Shared by every session and never mutated: OpenAI caches prompt prefixes
+# automatically, so the system prompt + tool schemas must stay byte-identical
+# at the start of every request. Don't edit or replace history[0].
+SYSTEM_MESSAGE = SystemMessage(content=SYSTEM_PROMPT)
+
+# Synthetic tool letting the model fan out several real tool calls in one go.
+# It is never sent to the MCP server; run_all expands it locally.
+BATCH_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "batch_tool",
+        "description": "Invoke multiple other tools in parallel and return all their results.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "invocations": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "name": {"type": "string"},
+                            "arguments": {"type": "object"},
+                        },
+                        "required": ["name", "arguments"],
+                    },
+                }
+            },
+            "required": ["invocations"],
+        },
+    },
+}
+
 # ─────────────────────────────
 # SYNC RUNNER
 # ─────────────────────────────
+@st.cache_resource
+def _loop():
+    # One loop for the whole process so the MCP client's HTTP pool stays alive.
+    # It runs in its own thread so concurrent sessions can submit work to it
+    # without fighting over run_until_complete.
+    loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="async-loop", daemon=True).start()
+    return loop
+
 def run_sync(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _loop()).result()
+
+def iter_sync(agen):
+    # Drives an async iterator on the cached loop one item at a time
     try:
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-    return loop.run_until_complete(coro)
+        while True:
+            try:
+                yield run_sync(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        # Close the generator (and any stream it holds) if the consumer stops early
+        run_sync(agen.aclose())
 
 # ─────────────────────────────
 # INITIALIZATION
 # ─────────────────────────────
+@st.cache_resource
+def _live_sessions():
+    # Close functions of every MCP session still open, shut down once at exit
+    sessions = set()
+
+    def close_all():
+        for close_mcp in list(sessions):
+            run_sync(close_mcp())
+
+    atexit.register(close_all)
+    return sessions
+
+@st.cache_resource
+def _reconnect_lock():
+    return threading.Lock()
+
 @st.cache_resource
 def get_mcp_resources():
     client = MultiServerMCPClient(SERVERS)
-    try:
-        tools = run_sync(client.get_tools())
-        
-        llm = ChatOpenAI(
+    # Hold one MCP session open on the cached loop; tools loaded from it reuse
+    # the same HTTP connection instead of opening a new session per call.
+    # The session is entered and exited by the same long-lived task, as anyio
+    # requires for its cancel scopes.
+    stop = asyncio.Event()
+    holder = []
+    live = _live_sessions()
+
+    async def hold_session(ready):
+        try:
+            async with client.session("expense") as session:
+                ready.set_result(session)
+                await stop.wait()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+
+    async def close_mcp():
+        stop.set()
+        if holder:
+            await holder[0]
+        live.discard(close_mcp)
+
+    live.add(close_mcp)
+
+    async def load_tools():
+        ready = asyncio.get_running_loop().create_future()
+        holder.append(asyncio.create_task(hold_session(ready)))
+        return await load_mcp_tools(await ready)
+
+    def init_llm():
+        return ChatOpenAI(
             model="gpt-4o-mini", 
             api_key=OPENAI_API_KEY,
             temperature=0
         )
-        llm_with_tools = llm.bind_tools(tools)
+
+    async def init():
+        # Tool discovery and LLM construction are independent; the constructor
+        # blocks, so it runs in a thread while tools load
+        return await asyncio.gather(load_tools(), asyncio.to_thread(init_llm))
+
+    try:
+        tools, llm = run_sync(init())
+        # Stable ordering keeps the bound tool schemas a cacheable prompt prefix
+        tools = sorted(tools, key=lambda t: t.name)
+
+        bound = llm.bind_tools(tools + [BATCH_TOOL])
+        # Keyed on the bound schemas so server-side tool changes invalidate entries
+        llm_with_tools = CachedLLM(
+            bound,
+            model=llm.model_name,
+            tool_schemas=bound.kwargs["tools"],
+            temperature=llm.temperature,
+        )
         
-        return client, tools, llm, llm_with_tools
+        # Tool name -> bound coroutine, resolved once instead of per call
+        dispatch = {t.name: t.ainvoke for t in tools}
+
+        return close_mcp, tools, llm, llm_with_tools, dispatch
     except Exception as e:
         st.error(f"❌ Initialization Error: {e}")
         st.stop()
@@ -70,53 +219,295 @@ def get_mcp_resources():
 st.set_page_config(page_title="AniTracker MCP", layout="centered")
 st.title("🧰 AniTracker — OpenAI Edition")
 
-client, tools, llm, llm_with_tools = get_mcp_resources()
+def reconnect_mcp(stale_close):
+    # Drop the session the failed calls used (e.g. expired server-side) and open
+    # a fresh one. If another browser session already replaced it, reuse theirs.
+    with _reconnect_lock():
+        if get_mcp_resources()[0] is stale_close:
+            try:
+                run_sync(stale_close())
+            except Exception:
+                pass
+            get_mcp_resources.clear()
+        return get_mcp_resources()
+
+# Opens the session on page load so initialization errors show up immediately
+get_mcp_resources()
 
 if "history" not in st.session_state:
-    st.session_state.history = [SystemMessage(content=SYSTEM_PROMPT)]
-    st.session_state.tool_by_name = {t.name: t for t in tools}
+    st.session_state.history = [SYSTEM_MESSAGE]
+
+# ─────────────────────────────
+# CONTEXT WINDOW
+# ─────────────────────────────
+def approx_tokens(msg):
+    return len(str(msg.content)) // 4
+
+def budget(history, llm, max_tokens=8000, batch=4, window_share=0.75):
+    """Keep the system prompt plus as many recent turns as fit in max_tokens.
+
+    Recent turns fill up to window_share of the budget. Older turns are folded
+    into a running summary, sending only the newly evicted turns along with the
+    previous summary. Evicted turns may wait in the prompt verbatim for a batch
+    to build up, but only while everything still fits in max_tokens.
+    """
+    system, rest = history[0], history[1:]
 
-# Render Chat History
-for msg in st.session_state.history:
-    if isinstance(msg, HumanMessage):
-        st.chat_message("user").write(msg.content)
-    elif isinstance(msg, AIMessage) and msg.content:
-        # This ensures we only render the final text content, not the tool_calls metadata
-        st.chat_message("assistant").write(msg.content)
+    # A turn is a HumanMessage plus the AI/tool messages that follow it
+    turns = []
+    for msg in rest:
+        if isinstance(msg, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(msg)
+    costs = [sum(approx_tokens(m) for m in turn) for turn in turns]
+
+    # (number of turns summarized, summary text)
+    summarized, summary = st.session_state.get("summary", (0, None))
+    base = approx_tokens(system) + len(summary or "") // 4
+
+    kept, used = 0, base
+    for cost in reversed(costs):
+        if kept and used + cost > max_tokens * window_share:
+            break
+        kept += 1
+        used += cost
+    evicted = len(turns) - kept
+
+    pending = max(evicted - summarized, 0)
+    if pending and (pending >= batch or used + sum(costs[summarized:evicted]) > max_tokens):
+        transcript = "\n".join(
+            f"{type(m).__name__}: {m.content}"
+            for turn in turns[summarized:evicted] for m in turn if m.content
+        )
+        if summary:
+            transcript = f"Summary so far: {summary}\n\nNew messages:\n{transcript}"
+        result = run_sync(llm.ainvoke([
+            SystemMessage(content="Summarize this conversation concisely, keeping any figures."),
+            HumanMessage(content=transcript),
+        ]))
+        summarized, summary = evicted, result.content
+        st.session_state.summary = (summarized, summary)
+
+    window = [m for turn in turns[summarized:] for m in turn]
+    if not summary:
+        return [system] + window
+    return [system, SystemMessage(content=f"Summary of earlier conversation: {summary}")] + window
 
 # ─────────────────────────────
-# MAIN CHAT LOOP
+# TOOL EXECUTION
 # ─────────────────────────────
-user_text = st.chat_input("Ask about expenses...")
+def parse_json(text):
+    # MCP tools return their payload as text; structured results are JSON
+    try:
+        data = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        return None
+    return data if isinstance(data, (dict, list)) else None
+
+def unwrap_blocks(result):
+    # MCP tools return text, or a list of text blocks (FastMCP emits one block
+    # per item for list results). A single block is unwrapped to its text;
+    # several become a list of items, each parsed as JSON where possible.
+    if not (isinstance(result, list) and result
+            and all(isinstance(b, dict) and b.get("type") == "text" for b in result)):
+        return result
+    if len(result) == 1:
+        return result[0]["text"]
+    items = []
+    for block in result:
+        try:
+            items.append(orjson.loads(block["text"]))
+        except orjson.JSONDecodeError:
+            items.append(block["text"])
+    return items
+
+def compact(result, max_items=25):
+    result = unwrap_blocks(result)
+    # Plain text is passed through rather than re-encoded as a JSON string
+    if isinstance(result, str):
+        data = parse_json(result)
+        if data is None:
+            return result
+        result = data
+    # Long lists (e.g. expense rows) are cut down to keep the final prompt small
+    if isinstance(result, list) and len(result) > max_items:
+        result = {"items": result[:max_items], "omitted": len(result) - max_items}
+    return orjson.dumps(result, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
 
-if user_text:
-    st.chat_message("user").write(user_text)
-    st.session_state.history.append(HumanMessage(content=user_text))
+def tool_content(result):
+    if isinstance(result, Exception):
+        return f"Error: {result}"
+    return compact(result)
 
-    with st.spinner("Processing..."):
+def is_transport_error(result):
+    # Connection/session failures, as opposed to errors reported by the tool itself
+    return isinstance(result, (httpx.HTTPError, anyio.ClosedResourceError,
+                               anyio.BrokenResourceError, McpError))
+
+def direct_answer(result, max_chars=400):
+    # Short prose (or a server-tagged display string) can be shown as-is,
+    # without a second LLM pass to reformat it. Anything that parses as JSON,
+    # scalars included, goes to the LLM.
+    result = unwrap_blocks(result)
+    if isinstance(result, str):
         try:
-            # Step 1: LLM decides if a tool is needed
-            response = llm_with_tools.invoke(st.session_state.history)
-            st.session_state.history.append(response)
-
-            # Step 2: If tool calls exist, execute them and get a final text response
-            if response.tool_calls:
-                for tc in response.tool_calls:
-                    tool = st.session_state.tool_by_name.get(tc["name"])
-                    if tool:
-                        result = run_sync(tool.ainvoke(tc["args"]))
-                        # Add the raw tool output to history (not displayed to user)
-                        st.session_state.history.append(
-                            ToolMessage(tool_call_id=tc["id"], content=json.dumps(result))
-                        )
-                
-                # Step 3: Final LLM call to turn JSON tool results into Text
-                final_response = llm.invoke(st.session_state.history)
-                st.session_state.history.append(final_response)
-                st.chat_message("assistant").write(final_response.content)
-            else:
-                # If no tool was needed, just print the direct response
-                st.chat_message("assistant").write(response.content)
+            result = orjson.loads(result)
+        except orjson.JSONDecodeError:
+            return result if len(result) < max_chars else None
+    if isinstance(result, dict) and isinstance(result.get("display"), str):
+        return result["display"]
+    return None
+
+async def run_all(calls, dispatch):
+    async def run_one(name, args):
+        if name not in dispatch:
+            raise KeyError(f"unknown tool {name!r}")
+        return await dispatch[name](args)
+
+    async def run_batch(invocations):
+        results = await asyncio.gather(
+            *(run_one(i["name"], i["arguments"]) for i in invocations),
+            return_exceptions=True,
+        )
+        return [f"Error: {r}" if isinstance(r, Exception) else r for r in results]
 
+    async def run_call(i, c):
+        try:
+            if c["name"] == "batch_tool":
+                return i, await run_batch(c["args"]["invocations"])
+            return i, await run_one(c["name"], c["args"])
         except Exception as e:
-            st.error(f"⚠️ Error: {e}")
\ No newline at end of file
+            return i, e
+
+    # Yields (index, result) as each call finishes so progress can be reported
+    # before the slowest one returns
+    for fut in asyncio.as_completed([run_call(i, c) for i, c in enumerate(calls)]):
+        yield await fut
+
+# ─────────────────────────────
+# MAIN CHAT LOOP
+# ─────────────────────────────
+if "transcript" not in st.session_state:
+    st.session_state.transcript = []
+    st.session_state.rendered_up_to = 0
+
+@st.fragment
+def chat_panel():
+    # Only this fragment reruns on chat input, not the whole script
+
+    # Render Chat History
+    # Only messages added since the last rerun are classified; the rest are replayed
+    # from the (role, text) transcript without re-inspecting history.
+    for msg in st.session_state.history[st.session_state.rendered_up_to:]:
+        if isinstance(msg, HumanMessage):
+            st.session_state.transcript.append(("user", msg.content))
+        elif isinstance(msg, AIMessage) and msg.content:
+            # This ensures we only render the final text content, not the tool_calls metadata
+            st.session_state.transcript.append(("assistant", msg.content))
+    st.session_state.rendered_up_to = len(st.session_state.history)
+
+    for role, text in st.session_state.transcript:
+        st.chat_message(role).markdown(text)
+
+    user_text = st.chat_input("Ask about expenses...")
+
+    if user_text:
+        # Read per turn: only this fragment reruns, so module-level values would
+        # keep pointing at a session that has since been replaced
+        close_mcp, tools, llm, llm_with_tools, dispatch = get_mcp_resources()
+
+        st.chat_message("user").write(user_text)
+        st.session_state.history.append(HumanMessage(content=user_text))
+
+        with st.spinner("Processing..."):
+            try:
+                # Step 1: LLM decides if a tool is needed
+                response = run_sync(llm_with_tools.ainvoke(budget(st.session_state.history, llm)))
+
+                # Step 2: If tool calls exist, execute them and get a final text response
+                if response.tool_calls:
+                    # Every tool_call must be answered by a ToolMessage, so unknown
+                    # tools are not filtered out; run_all reports them as errors
+                    calls = response.tool_calls
+                    # Identical calls (same name + args) are only executed once
+                    unique, id_to_key = {}, {}
+                    for tc in calls:
+                        key = (tc["name"], orjson.dumps(tc["args"], option=orjson.OPT_SORT_KEYS))
+                        unique.setdefault(key, tc)
+                        id_to_key[tc["id"]] = key
+
+                    # Independent tool calls are dispatched concurrently
+                    unique_calls = list(unique.values())
+                    results = [None] * len(unique_calls)
+                    with st.status("Running tools...") as status:
+                        # Progress is written from this script thread, not the loop thread
+                        for i, result in iter_sync(run_all(unique_calls, dispatch)):
+                            results[i] = result
+                            mark = "✗" if isinstance(result, Exception) else "✓"
+                            status.write(f"Tool `{unique_calls[i]['name']}` completed {mark}")
+
+                        # Retry once on a fresh session if the connection was lost
+                        failed = [i for i, r in enumerate(results) if is_transport_error(r)]
+                        if failed:
+                            status.write("Reconnecting to the MCP server...")
+                            fresh_dispatch = reconnect_mcp(close_mcp)[-1]
+                            retry = [unique_calls[i] for i in failed]
+                            for j, result in iter_sync(run_all(retry, fresh_dispatch)):
+                                results[failed[j]] = result
+                                mark = "✗" if isinstance(result, Exception) else "✓"
+                                status.write(f"Tool `{retry[j]['name']}` completed {mark}")
+                        status.update(label="Tools completed", state="complete")
+                    results_by_key = dict(zip(unique, results))
+                    tool_messages = [
+                        ToolMessage(
+                            tool_call_id=tc["id"],
+                            content=tool_content(results_by_key[id_to_key[tc["id"]]]),
+                        )
+                        for tc in calls
+                    ]
+                    # The AIMessage is only added together with the ToolMessages that
+                    # answer its tool_calls; an unanswered tool_call would make every
+                    # later request fail. Raw tool output is not displayed to the user.
+                    st.session_state.history += [response, *tool_messages]
+
+                    answers = [direct_answer(r) for r in results]
+                    if answers and all(a is not None for a in answers):
+                        # Results are already human-readable; skip the formatting pass
+                        if len(answers) == 1:
+                            final_text = answers[0]
+                        else:
+                            final_text = "\n\n".join(
+                                f"**{tc['name']}**: {answer}"
+                                for tc, answer in zip(unique_calls, answers)
+                            )
+                        st.chat_message("assistant").markdown(final_text)
+                        st.session_state.history.append(AIMessage(content=final_text))
+                    else:
+                        # Step 3: Final LLM call to turn JSON tool results into Text (streamed)
+                        prompt = budget(st.session_state.history, llm)
+
+                        async def gen():
+                            async for chunk in llm.astream(prompt):
+                                if chunk.content:
+                                    yield chunk.content
+
+                        # Update one placeholder in place, at most every 50 ms,
+                        # instead of sending a frontend delta per chunk
+                        placeholder = st.chat_message("assistant").empty()
+                        final_text, last_flush = "", time.monotonic()
+                        for chunk in iter_sync(gen()):
+                            final_text += chunk
+                            if time.monotonic() - last_flush >= 0.05:
+                                placeholder.markdown(final_text)
+                                last_flush = time.monotonic()
+                        placeholder.markdown(final_text)
+                        st.session_state.history.append(AIMessage(content=final_text))
+                else:
+                    # If no tool was needed, just print the direct response
+                    st.session_state.history.append(response)
+                    st.chat_message("assistant").markdown(response.content)
+
+            except Exception as e:
+                st.error(f"⚠️ Error: {e}")
+
+chat_panel()
@@ -0,0 +1,88 @@
+import json
+import hashlib
+from collections import OrderedDict
+
+from langchain_core.messages import AIMessage
+
+try:
+    import diskcache
+except ImportError:  # disk layer is optional; the in-memory LRU still works
+    diskcache = None
+
+
+class CacheBackend:
+    """Bounded in-memory LRU in front of a size-limited on-disk cache."""
+
+    def __init__(self, directory="./.llm_cache", max_items=256, disk_size_limit=2**28):
+        self.memory = OrderedDict()
+        self.max_items = max_items
+        self.disk = diskcache.Cache(directory, size_limit=disk_size_limit) if diskcache else None
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self._remember(key, value)
+            return value
+        return None
+
+    def set(self, key, value):
+        self._remember(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+
+class CachedLLM:
+    """Wraps a chat model and replays responses for identical requests.
+
+    Caching is bypassed unless temperature is 0, since only then are
+    responses deterministic.
+    """
+
+    def __init__(self, llm, model, tool_schemas=(), temperature=None, backend=None):
+        self.llm = llm
+        self.model = model
+        self.tool_schemas = list(tool_schemas)
+        self.enabled = temperature == 0
+        self.backend = backend or CacheBackend()
+
+    @staticmethod
+    def _message(m):
+        # Only fields that affect the completion; ids and usage metadata vary per call
+        return {
+            "role": m.type,
+            "content": m.content,
+            "tool_calls": getattr(m, "tool_calls", None),
+            "tool_call_id": getattr(m, "tool_call_id", None),
+        }
+
+    def key(self, messages):
+        payload = {
+            "model": self.model,
+            "messages": [self._message(m) for m in messages],
+            "tools": self.tool_schemas,
+        }
+        raw = json.dumps(payload, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    async def ainvoke(self, messages):
+        if not self.enabled:
+            return await self.llm.ainvoke(messages)
+
+        key = self.key(messages)
+        hit = self.backend.get(key)
+        if hit is not None:
+            return AIMessage(content=hit["content"], tool_calls=hit["tool_calls"])
+
+        response = await self.llm.ainvoke(messages)
+        self.backend.set(key, {"content": response.content, "tool_calls": response.tool_calls})
+        return response